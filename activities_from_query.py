@@ -10,17 +10,31 @@
    instead of just providing the date field for each club activity. :(
 """
 
-import dataclasses
 import datetime
+import heapq
 import json
 import os
+import pickle
 import pprint
+import sys
+import tempfile
 
-from typing import Any
+from collections import defaultdict
+from operator import itemgetter
+from typing import Any, Iterator, NamedTuple, Optional
 
 
-@dataclasses.dataclass(frozen=True, eq=False)
-class Activity():
+# Parsed activities are cached next to each query file so repeat runs skip the JSON parse.
+# Bump CACHE_VERSION whenever the pickled structure (e.g. Activity) changes.
+CACHE_SUFFIX = ".cache.pkl"
+CACHE_VERSION = 2
+
+# Field lookups for a Strava activity, in Activity field order.
+GET_ATHLETE_NAME = itemgetter("firstname", "lastname")
+GET_ACTIVITY_FIELDS = itemgetter("sport_type", "distance", "elapsed_time", "moving_time")
+
+
+class Activity(NamedTuple):
     # Things I care about.
     sport_type: str
     distance_meters: int
@@ -29,43 +43,92 @@ class Activity():
     elapsed_time_s: int
     moving_time_s: int
 
-    def __eq__(self, other):
-        return all((self.sport_type == other.sport_type,
-            self.distance_meters == other.distance_meters,
-            self.elapsed_time_s == other.elapsed_time_s,
-            self.moving_time_s == other.moving_time_s))
 
-
-def get_file_names() -> list[str]:
+def get_file_names() -> Iterator[str]:
     """
-    Returns:
+    Yields:
         Any file that starts with `query_`, assuming that all files take the form
         `query_yyyy_mm_dd_hh-MM-ss.json` (year, month, day, hour, minute, second).
     """
-    files = [ff for ff in os.listdir(".") if os.path.isfile(ff) and ff.startswith("query_")]
-    return files
+    with os.scandir(".") as entries:
+        for entry in entries:
+            if entry.is_file() and entry.name.startswith("query_") and entry.name.endswith(".json"):
+                yield entry.name
 
 
-def parse_activities(query_file: str) -> dict[str, Activity]:
+def load_cached_activities(cache_file: str, cache_key: tuple) -> Optional[dict[str, list[Activity]]]:
     """
+    Assumes:
+        * The directory holding `cache_file` is trusted. The cache is a pickle, and unpickling a
+          file can run arbitrary code.
+
+    Returns:
+        The activities pickled in `cache_file`, or None if the cache is missing, unreadable, or was
+        written for a different `cache_key`.
+    """
+    try:
+        with open(cache_file, "rb") as ff:
+            key, activities_by_athlete = pickle.load(ff)
+    except Exception:
+        # Any failure to load the cache (e.g. it pickled a module that isn't importable here) just
+        # means re-parsing the query file.
+        return None
+    if key != cache_key:
+        return None
+    return activities_by_athlete
+
+
+def save_cached_activities(cache_file: str, cache_key: tuple,
+                           activities_by_athlete: dict[str, list[Activity]]) -> None:
+    """
+    Pickles the activities to a temp file and moves it over `cache_file`, so an interrupted run never
+    leaves a half-written cache. The cache is optional: if it can't be written, nothing is saved.
+    """
+    cache_dir = os.path.dirname(cache_file) or "."
+    try:
+        fd, tmp_file = tempfile.mkstemp(dir=cache_dir, suffix=".tmp")
+    except OSError:
+        return
+    try:
+        with os.fdopen(fd, "wb") as ff:
+            pickle.dump((cache_key, activities_by_athlete), ff)
+        os.replace(tmp_file, cache_file)
+    except (OSError, pickle.PicklingError):
+        try:
+            os.remove(tmp_file)
+        except OSError:
+            pass
+
+
+def parse_activities(query_file: str) -> dict[str, list[Activity]]:
+    """
+    Assumes:
+        * A query file that keeps its mtime and size has not changed, so its cached parse is reused.
+
     Returns:
         {<athlete name>: <list of activities>}
     """
+    query_stat = os.stat(query_file)
+    cache_file = query_file + CACHE_SUFFIX
+    cache_key = (CACHE_VERSION, query_stat.st_mtime_ns, query_stat.st_size)
+    cached = load_cached_activities(cache_file, cache_key)
+    if cached is not None:
+        return cached
+
     with open(query_file, "r") as ff:
-        lines = ff.readlines()
-    activities = json.loads("".join(lines))
-    activities_by_athlete = {}
+        activities = json.load(ff)
+    activities_by_athlete = defaultdict(list)
     for activity in activities:
-        athlete = activity["athlete"]["firstname"] + " " + activity["athlete"]["lastname"]
-        sport = activity["sport_type"]
-        distance_meters = activity["distance"]
-        elapsed_s = activity["elapsed_time"]
-        moving_s = activity["moving_time"]
-        if athlete not in activities_by_athlete:
-            activities_by_athlete[athlete] = []
+        # Interned so every activity by the same athlete shares one key object.
+        firstname, lastname = GET_ATHLETE_NAME(activity["athlete"])
+        athlete = sys.intern(firstname + " " + lastname)
+        sport, distance_meters, elapsed_s, moving_s = GET_ACTIVITY_FIELDS(activity)
         activities_by_athlete[athlete].append(
             Activity(sport, distance_meters, elapsed_s, moving_s)
         )
+    activities_by_athlete = dict(activities_by_athlete)
+
+    save_cached_activities(cache_file, cache_key, activities_by_athlete)
     return activities_by_athlete
 
 
@@ -73,26 +136,27 @@ def get_diff(per_athlete_1: dict[str, list[Activity]], per_athlete_2: dict[str,
     """
     Assumes:
         * If the contents of an Activity are different, then that is a unique activity.
-        * Performance doesn't matter (list iteration comparison).
+        * Repeated copies of an activity in per_athlete_2 (e.g. overlapping query pages)
+          are the same activity and are only reported once.
 
     Returns:
         Any content in per_athlete_2 that is not in per_athlete_1.
     """
     unique_activities = {}
     for athlete, maybe_new_activities in per_athlete_2.items():
-        if athlete not in per_athlete_1.keys():
-            unique_activities[athlete] = maybe_new_activities
+        # dict.fromkeys drops repeats while keeping their order.
+        deduped = dict.fromkeys(maybe_new_activities)
+        old_list = per_athlete_1.get(athlete)
+        if old_list is None:
+            unique_activities[athlete] = list(deduped)
             continue
 
-        # This athlete is in the first dict.
-        for maybe_new_activity in maybe_new_activities:
-            # Lol performance wut?
-            for old_activity in per_athlete_1[athlete]:
-                if maybe_new_activity != old_activity:
-                    if athlete not in unique_activities:
-                        unique_activities[athlete] = []
-                    unique_activities[athlete].append(maybe_new_activity)
-                    break
+        # Activities are hashable, so a set gives O(1) membership checks instead of scanning every
+        # old activity.
+        old_set = set(old_list)
+        new_activities = [aa for aa in deduped if aa not in old_set]
+        if new_activities:
+            unique_activities[athlete] = new_activities
     return unique_activities
 
 
@@ -101,19 +165,19 @@ def count_runs(activities_by_athlete: dict[str, list[Activity]], threshold_meter
     Returns:
         {"<runner name>": <runs over threshold>}
     """
-    runs_over_threshold = {}
-    for athlete, activities in activities_by_athlete.items():
-        runs_over_threshold[athlete] = 0
-        for activity in activities:
-            if activity.sport_type == "Run" and activity.distance_meters > threshold_meters:
-                runs_over_threshold[athlete] += 1
+    runs_over_threshold = {
+        athlete: sum(1 for activity in activities
+                     if activity.sport_type == "Run" and activity.distance_meters > threshold_meters)
+        for athlete, activities in activities_by_athlete.items()
+    }
     return runs_over_threshold
 
 
 def main():
-    all_files = sorted(get_file_names())
-    activities_older_query = parse_activities(all_files[-2])
-    activities_newer_query = parse_activities(all_files[-1])
+    # The file name format sorts chronologically, so the two largest names are the newest queries.
+    newer_file, older_file = heapq.nlargest(2, get_file_names())
+    activities_older_query = parse_activities(older_file)
+    activities_newer_query = parse_activities(newer_file)
     new_activities_by_athlete = get_diff(activities_older_query, activities_newer_query)
     valid_runs_per_athlete = count_runs(new_activities_by_athlete, 400)  # 0.25 miles ~= 400 meters
     pprint.pprint(valid_runs_per_athlete)